@@ -0,0 +1,461 @@
+# SPDX-FileCopyrightText: 2021 Chorus One AG
+# SPDX-License-Identifier: GPL-3.0
+
+"""
+Fixtures for the MEV tests.
+
+Starting the validator, deploying the Orca program, and setting up the tokens
+and pools is what dominates the runtime of the tests, so all of it happens once
+per test session, and the tests share the result.
+"""
+
+import asyncio
+import functools
+import os
+import secrets
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Iterator, List, NamedTuple, Tuple, TypeVar
+
+import pytest
+import toml
+
+from util import (
+    ROOT_PATH,
+    SplTokenBalance,
+    TokenPool,
+    TestAccount,
+    create_test_account,
+    create_test_accounts_bulk,
+    deploy_token_pool,
+    solana_program_deploy_cached,
+    spl_token,
+    spl_token_async,
+    start_validator,
+    restart_validator,
+    compile_bpf_program_cached,
+    get_default_keypair_path,
+    get_validator_output,
+    keypair_pubkey,
+    rpc_get_balance,
+)
+
+T = TypeVar('T')
+
+# Paths are based on the root of the repository, resolved once at import.
+DEPLOY_PATH = os.path.join(ROOT_PATH, 'mev-tests/target/deploy')
+HELPER_PROGRAMS_PATH = os.path.join(ROOT_PATH, 'mev-tests/helper-programs')
+KEYS_PATH = os.path.join(ROOT_PATH, 'mev-tests/.keys')
+INNER_SWAP_SO_PATH = os.path.join(HELPER_PROGRAMS_PATH, 'target/deploy/inner_swap.so')
+
+
+class PoolSpec(NamedTuple):
+    """
+    A pool to set up for the tests: which of the test tokens it trades (as
+    indices into the `tokens` fixture), and how much liquidity it starts with.
+    """
+
+    pool_id: str
+    # Label of the pool in the MEV config.
+    label: str
+    token_a: int
+    token_b: int
+    token_a_liquidity: str
+    token_b_liquidity: str
+
+
+# The pools P0, P1 and P2 form the arbitrage path that the tests expect the
+# validator to find, the liquidity is chosen such that there is an opportunity.
+POOL_SPECS = [
+    PoolSpec('P0', 'P0: Token0, Token1', 0, 1, '32500.951164566', '1030.701091486'),
+    PoolSpec('P1', 'P1: Token0, Token2', 0, 2, '6761.724934325', '15.245225568'),
+    PoolSpec('P2', 'Token2, Token1', 2, 1, '0.000453975', '0.006517227'),
+]
+
+# validator config filename
+config_file = os.path.join(ROOT_PATH, 'mev-tests/mev_config.toml')
+
+
+async def create_account_and_mint_tokens(
+    keypair_path: str, amount: str, mint_address: str
+) -> TestAccount:
+    token_account = create_test_account(keypair_path, fund=False)
+    await spl_token_async(
+        'create-account',
+        mint_address,
+        token_account.keypair_path,
+        '--output',
+        'json',
+    )
+    await spl_token_async('mint', mint_address, amount, token_account.pubkey)
+    return token_account
+
+
+async def create_token_with_account(
+    test_dir: str, token_id: int, owner: TestAccount
+) -> Tuple[TestAccount, TestAccount]:
+    """
+    Create a token mint, and a token account for it owned by `owner`.
+    Returns the mint and the token account.
+    """
+    token_mint = create_test_account(
+        os.path.join(test_dir, f'token-{token_id}-mint.json'), fund=False
+    )
+    await spl_token_async(
+        'create-token',
+        token_mint.keypair_path,
+        '--decimals',
+        '9',
+    )
+    token_account = create_test_account(
+        os.path.join(test_dir, f'miner-token-account-{token_id}.json'), fund=False
+    )
+    await spl_token_async(
+        'create-account',
+        token_mint.pubkey,
+        token_account.keypair_path,
+        '--owner',
+        owner.pubkey,
+        '--output',
+        'json',
+    )
+    return token_mint, token_account
+
+
+async def create_pool_token_accounts(
+    test_dir: str, token_mints: List[TestAccount], pool_spec: PoolSpec
+) -> Tuple[TestAccount, TestAccount]:
+    """
+    Create the token accounts that provide the initial liquidity of a pool, and
+    mint the liquidity into them. The mints are shared between pools, so a new
+    pool only costs us its two token accounts, not two new tokens.
+    """
+    pool_id = pool_spec.pool_id
+    # The two token accounts are independent of each other, so we create and
+    # fund them concurrently.
+    t_a_account, t_b_account = await asyncio.gather(
+        create_account_and_mint_tokens(
+            os.path.join(test_dir, f'token-{pool_id}-token-0-account.json'),
+            pool_spec.token_a_liquidity,
+            token_mints[pool_spec.token_a].pubkey,
+        ),
+        create_account_and_mint_tokens(
+            os.path.join(test_dir, f'token-{pool_id}-token-1-account.json'),
+            pool_spec.token_b_liquidity,
+            token_mints[pool_spec.token_b].pubkey,
+        ),
+    )
+    print(
+        f'> Minted ourselves {pool_spec.token_a_liquidity} of token 0 from {pool_id}.'
+    )
+    print(
+        f'> Minted ourselves {pool_spec.token_b_liquidity} of token 1 from {pool_id}.'
+    )
+    return t_a_account, t_b_account
+
+
+def create_pool(
+    token_swap_program_id: str,
+    token_mints: List[TestAccount],
+    pool_spec: PoolSpec,
+    token_accounts: Tuple[TestAccount, TestAccount],
+) -> TokenPool:
+    """
+    Deploy a token pool, with the liquidity in the given token accounts.
+    """
+    t_a_account, t_b_account = token_accounts
+    token_pool = deploy_token_pool(
+        token_swap_program_id,
+        t_a_account.pubkey,
+        t_b_account.pubkey,
+        token_mints[pool_spec.token_a].pubkey,
+        token_mints[pool_spec.token_b].pubkey,
+    )
+    print(f'> Token Pool created with address {token_pool.token_swap_account}')
+    return token_pool
+
+
+async def gather(*coros: Awaitable[T]) -> List[T]:
+    """
+    Run the coroutines concurrently, return their results in order.
+    """
+    return list(await asyncio.gather(*coros))
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item: pytest.Item, call: pytest.CallInfo[None]) -> Any:
+    """
+    Attach the last output of the validator to the report of a failed test.
+    """
+    outcome = yield
+    report: pytest.TestReport = outcome.get_result()
+    if report.failed:
+        report.sections.append(('validator output', get_validator_output()))
+
+
+@pytest.fixture(scope='session')
+def test_dir() -> str:
+    """
+    A fresh directory where we store all the keys and configuration for this
+    test session.
+    """
+    run_id = secrets.token_hex(5)
+    test_dir = os.path.join(KEYS_PATH, run_id)
+    os.makedirs(test_dir, exist_ok=True)
+    print(f'Keys directory: {test_dir}')
+    return test_dir
+
+
+@pytest.fixture(scope='session')
+def test_validator(
+    inner_swap_program_build: 'Future[None]',
+) -> Iterator[subprocess.Popen[bytes]]:
+    """
+    The validator, started without MEV config. See `mev_validator` for the
+    validator that extracts MEV.
+
+    Every test that needs the validator also needs the inner swap program, so
+    its build starts first, and overlaps with starting the validator and
+    creating the tokens.
+    """
+    # Start the validator. Its output is kept in memory, and attached to the
+    # report of a failing test, see `pytest_runtest_makereport`.
+    test_validator = start_validator()
+    yield test_validator
+    test_validator.terminate()
+
+
+@pytest.fixture(scope='session')
+def token_swap_program_id(test_validator: subprocess.Popen[bytes]) -> str:
+    # Before we start, check our current balance. We also do this at the end,
+    # and then we know how much the deployment cost.
+    fee_payer = keypair_pubkey(get_default_keypair_path())
+    lamports_pre = rpc_get_balance(fee_payer)
+
+    # The validator keeps its ledger between runs, so the Orca program that we
+    # deployed in a previous run may still be there. If so, reuse it rather
+    # than uploading it again.
+    print('\nUploading Orca Token Swap program ...')
+    # first run:
+    # solana program dump ORCA_PROGRAM_ID 'path/orca_token_swap_v2.so'
+    token_swap_program_id = solana_program_deploy_cached(
+        os.path.join(DEPLOY_PATH, 'orca_token_swap_v2.so'),
+        os.path.join(KEYS_PATH, 'orca_program_id'),
+    )
+
+    # Balances are read at confirmed commitment, so the deployment is already
+    # reflected here.
+    lamports_post = rpc_get_balance(fee_payer)
+    if lamports_post != lamports_pre:
+        print(f'> Deployment cost {(lamports_pre - lamports_post) / 1e9} SOL')
+
+    print(f'> Token swap program id is {token_swap_program_id}')
+    return token_swap_program_id
+
+
+@pytest.fixture(scope='session')
+def miner_authority(
+    test_validator: subprocess.Popen[bytes], test_dir: str
+) -> TestAccount:
+    # The tests run against the test validator, which has a faucet.
+    (miner_authority,) = create_test_accounts_bulk(
+        [os.path.join(test_dir, 'miner_authority.json')], airdrop=True
+    )
+    return miner_authority
+
+
+@pytest.fixture(scope='session')
+def tokens(
+    test_dir: str, miner_authority: TestAccount
+) -> List[Tuple[TestAccount, TestAccount]]:
+    """
+    Three token mints, each with a token account owned by the miner authority.
+    """
+    # The tokens are independent of each other, so we create them concurrently;
+    # the calls for a single token still happen in order.
+    return asyncio.run(
+        gather(
+            *(create_token_with_account(test_dir, i, miner_authority) for i in range(3))
+        )
+    )
+
+
+@pytest.fixture(scope='session')
+def token_mints(tokens: List[Tuple[TestAccount, TestAccount]]) -> List[TestAccount]:
+    return [token_mint for token_mint, _ in tokens]
+
+
+@pytest.fixture(scope='session')
+def miner_token_accounts(
+    tokens: List[Tuple[TestAccount, TestAccount]],
+) -> List[TestAccount]:
+    return [token_account for _, token_account in tokens]
+
+
+@pytest.fixture(scope='session')
+def token_pools(
+    test_dir: str, token_swap_program_id: str, token_mints: List[TestAccount]
+) -> Tuple[TokenPool, TokenPool, TokenPool]:
+    # Set up the liquidity of all pools at once, before we deploy any of them,
+    # so the account creations and mints of different pools overlap.
+    pool_token_accounts = asyncio.run(
+        gather(
+            *(
+                create_pool_token_accounts(test_dir, token_mints, pool_spec)
+                for pool_spec in POOL_SPECS
+            )
+        )
+    )
+    # The pools are independent too, and deploying one mostly waits for the
+    # validator to confirm, so we deploy them in parallel.
+    with ThreadPoolExecutor(max_workers=len(POOL_SPECS)) as executor:
+        token_pool_p0, token_pool_p1, token_pool_p2 = executor.map(
+            functools.partial(create_pool, token_swap_program_id, token_mints),
+            POOL_SPECS,
+            pool_token_accounts,
+        )
+    return token_pool_p0, token_pool_p1, token_pool_p2
+
+
+@pytest.fixture(scope='session')
+def initial_balance(
+    token_mints: List[TestAccount], miner_token_accounts: List[TestAccount]
+) -> SplTokenBalance:
+    """
+    Mint T1 Token to ourselves so we can extract MEV, return the balance.
+    """
+    spl_token('mint', token_mints[1].pubkey, '1.0', miner_token_accounts[1].pubkey)
+    # The account was created empty in this session, and the token has 9
+    # decimals, so we know the balance without asking the validator.
+    initial_balance = SplTokenBalance(balance_raw=1_000_000_000, balance_ui=1.0)
+    print(
+        f'  Minted ourselves {initial_balance.balance_ui} token {token_mints[1].pubkey}\
+ into {miner_token_accounts[1].pubkey} so we can extract opportunities'
+    )
+    return initial_balance
+
+
+@pytest.fixture(scope='session')
+def mev_validator(
+    test_validator: subprocess.Popen[bytes],
+    token_swap_program_id: str,
+    miner_authority: TestAccount,
+    token_mints: List[TestAccount],
+    miner_token_accounts: List[TestAccount],
+    token_pools: Tuple[TokenPool, TokenPool, TokenPool],
+    initial_balance: SplTokenBalance,
+) -> Iterator[subprocess.Popen[bytes]]:
+    """
+    The validator, restarted with a MEV config that watches the pools.
+    """
+    token_pool_p0, token_pool_p1, token_pool_p2 = token_pools
+    pool_tokens = [token_account.pubkey for token_account in miner_token_accounts]
+
+    ## create toml file
+    d_data = {
+        'log_path': '/tmp/mev.log',
+        'watched_programs': [token_swap_program_id],
+        'user_authority_path': miner_authority.keypair_path,
+        'minimum_profit': {token_mints[1].pubkey: 0},
+        'orca_account': [
+            {
+                '_id': pool_spec.label,
+                'address': token_pool.token_swap_account,
+                'pool_a_account': token_pool.token_swap_a_account,
+                'pool_b_account': token_pool.token_swap_b_account,
+                'pool_mint': token_pool.pool_mint_account,
+                'pool_fee': token_pool.pool_fee_account,
+                'source': pool_tokens[pool_spec.token_a],
+                'destination': pool_tokens[pool_spec.token_b],
+            }
+            for pool_spec, token_pool in zip(POOL_SPECS, token_pools)
+        ],
+        'mev_path': [
+            {
+                'name': 'P0->P1->P2',
+                'path': [
+                    {'pool': token_pool_p0.token_swap_account, 'direction': 'BtoA'},
+                    {'pool': token_pool_p1.token_swap_account, 'direction': 'AtoB'},
+                    {'pool': token_pool_p2.token_swap_account, 'direction': 'AtoB'},
+                ],
+            }
+        ],
+    }
+
+    # Write to a temporary file and rename it into place, so the validator can
+    # never observe a partially written config.
+    config_file_tmp = config_file + '.tmp'
+    with open(config_file_tmp, 'w') as f:
+        toml.dump(d_data, f)
+    os.replace(config_file_tmp, config_file)
+
+    ## will stop and re-start validator with toml file
+    mev_validator = restart_validator(test_validator, config_file=config_file)
+    yield mev_validator
+    mev_validator.terminate()
+
+
+@pytest.fixture(scope='session')
+def client_token_accounts(
+    mev_validator: subprocess.Popen[bytes],
+    test_dir: str,
+    token_pools: Tuple[TokenPool, TokenPool, TokenPool],
+) -> Tuple[TestAccount, TestAccount]:
+    """
+    Token accounts holding some of both tokens of pool P0, to swap with.
+    """
+    token_pool_p0 = token_pools[0]
+    print(f'> Minting ourselves some tokens')
+    t0_account, t1_account = asyncio.run(
+        gather(
+            create_account_and_mint_tokens(
+                os.path.join(test_dir, 'client-token-0-account.json'),
+                '2.1',
+                token_pool_p0.token_mint_a_account,
+            ),
+            create_account_and_mint_tokens(
+                os.path.join(test_dir, 'client-token-1-account.json'),
+                '2.1',
+                token_pool_p0.token_mint_b_account,
+            ),
+        )
+    )
+    return t0_account, t1_account
+
+
+@pytest.fixture(scope='session')
+def inner_swap_program_build() -> Iterator['Future[None]']:
+    """
+    Compile the BPF program to swap with an inner program in the background,
+    see `test_validator`.
+    """
+    print('> Compiling the BPF program to swap with an inner program')
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        build = executor.submit(
+            compile_bpf_program_cached,
+            cargo_manifest=os.path.join(
+                HELPER_PROGRAMS_PATH, 'inner-swap-program/Cargo.toml'
+            ),
+            so_fname=INNER_SWAP_SO_PATH,
+        )
+        yield build
+
+    # If no test deployed the program, nothing waited for the build. Re-raise
+    # here if it failed, so a broken build does not go unnoticed.
+    build.result()
+
+
+@pytest.fixture(scope='session')
+def inner_token_swap_program_id(
+    mev_validator: subprocess.Popen[bytes],
+    inner_swap_program_build: 'Future[None]',
+) -> str:
+    # Wait for the build, and re-raise if it failed.
+    inner_swap_program_build.result()
+    print('> Uploading inner token swap program ...')
+
+    inner_token_swap_program_id = solana_program_deploy_cached(
+        INNER_SWAP_SO_PATH, os.path.join(KEYS_PATH, 'inner_swap_program_id')
+    )
+    print(f'> Inner token swap program id is {inner_token_swap_program_id}')
+    return inner_token_swap_program_id
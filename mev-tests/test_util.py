@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2021 Chorus One AG
+# SPDX-License-Identifier: GPL-3.0
+
+"""
+Test the parts of `util.py` that don't need a validator: the key and address
+derivation, which we do ourselves rather than running `solana-keygen` and
+`spl-token`, and following the MEV log.
+
+The expected keys and addresses were cross-checked against `solders`.
+"""
+
+import os.path
+import sys
+from pathlib import Path
+
+import pytest
+
+from util import (
+    MevLogTail,
+    _ed25519_public_key,
+    b58decode,
+    b58encode,
+    find_program_address,
+    get_associated_token_address,
+    keypair_pubkey,
+    write_new_keypair,
+)
+
+# Test vector 1 from RFC 8032, section 7.1.
+RFC8032_SECRET_KEY = '9d61b19deffd5a60ba844af492ec2cc44449c5697b326919703bac031cae7f60'
+RFC8032_PUBLIC_KEY = 'd75a980182b10ab7d54bfed3c964073a0ee172f3daa62325af021a68f707511a'
+RFC8032_PUBKEY_B58 = 'FVen3X669xLzsi6N2V91DoiyzHzg1uAgqiT8jZ9nS96Z'
+
+WRAPPED_SOL_MINT = 'So11111111111111111111111111111111111111112'
+BPF_LOADER_UPGRADEABLE_PROGRAM_ID = 'BPFLoaderUpgradeab1e11111111111111111111111'
+
+
+def test_ed25519_public_key() -> None:
+    public_key = _ed25519_public_key(bytes.fromhex(RFC8032_SECRET_KEY))
+    assert public_key.hex() == RFC8032_PUBLIC_KEY
+    assert b58encode(public_key) == RFC8032_PUBKEY_B58
+
+
+def test_b58_roundtrip() -> None:
+    # Leading zero bytes are encoded as leading ones.
+    assert b58encode(bytes(32)) == '1' * 32
+    assert b58decode('1' * 32) == bytes(32)
+    assert b58decode(RFC8032_PUBKEY_B58) == bytes.fromhex(RFC8032_PUBLIC_KEY)
+
+
+def test_find_program_address() -> None:
+    # The bumps 255 and 254 give points on the curve for these seeds, so this
+    # also checks that those are skipped.
+    assert find_program_address(
+        [b58decode(RFC8032_PUBKEY_B58)], BPF_LOADER_UPGRADEABLE_PROGRAM_ID
+    ) == ('D77rcRMzWfTncaBbR7phv9kiVvSdfif3kf1tNfrZjy12', 253)
+
+
+def test_get_associated_token_address() -> None:
+    assert (
+        get_associated_token_address(RFC8032_PUBKEY_B58, WRAPPED_SOL_MINT)
+        == '43QbFUJCc1TjAMeUYQnDmDejbwnKz7c9UtZzpMHxWgVx'
+    )
+
+
+def test_write_new_keypair(tmp_path: Path) -> None:
+    keypair_fname = os.path.join(tmp_path, 'keypair.json')
+    pubkey = write_new_keypair(keypair_fname)
+    assert keypair_pubkey(keypair_fname) == pubkey
+    assert os.stat(keypair_fname).st_mode & 0o777 == 0o600
+
+
+def test_mev_log_tail(tmp_path: Path) -> None:
+    log_path = os.path.join(tmp_path, 'mev.log')
+    with open(log_path, 'w') as f:
+        f.write('{"event": "before"}\n')
+
+    # The tail starts at the end of the log, so it skips what was there.
+    tail = MevLogTail(log_path)
+    with open(log_path, 'a') as f:
+        f.write('{"event": "first"}\n{"event": "sec')
+    # The second line is not complete yet, it is left for the next read.
+    assert tail.read_new() == [{'event': 'first'}]
+
+    with open(log_path, 'a') as f:
+        f.write('ond"}\n')
+    assert tail.read_new() == [{'event': 'second'}]
+    assert tail.read_new() == []
+
+    assert MevLogTail(log_path, from_start=True).read_new() == [
+        {'event': 'before'},
+        {'event': 'first'},
+        {'event': 'second'},
+    ]
+
+
+if __name__ == '__main__':
+    sys.exit(pytest.main([__file__, '-s', *sys.argv[1:]]))
@@ -5,16 +5,30 @@
 Utilities that help writing tests, mainly for invoking programs.
 """
 
+import asyncio
+import atexit
+import base64
+import collections
+import functools
+import hashlib
+import itertools
 import json
 import os.path
+import re
+import secrets
 import time
 import subprocess
 import sys
+import threading
 
-from urllib import request
-from uuid import uuid4
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.parse import urlsplit
 
-from typing import List, NamedTuple, Any, Optional, Dict
+from typing import List, NamedTuple, Any, Optional, Deque, Dict, Tuple
+
+# The root of the repository. Paths are based on this rather than on the working
+# directory, so the tests work no matter where they are started from.
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
 class TestAccount(NamedTuple):
@@ -29,8 +43,13 @@ def run(*args: str) -> str:
     """
     Run a program, ensure it exits with code 0, return its stdout.
     """
+    # Stderr is only ever printed with --verbose, see below. Programs like cargo
+    # can write a lot to it, so without --verbose, don't bother collecting it.
+    stderr = subprocess.PIPE if '--verbose' in sys.argv else subprocess.DEVNULL
     try:
-        result = subprocess.run(args, check=True, capture_output=True, encoding='utf-8')
+        result = subprocess.run(
+            args, check=True, stdout=subprocess.PIPE, stderr=stderr, encoding='utf-8'
+        )
 
     except subprocess.CalledProcessError as err:
         # If a test fails, it is helpful to print stdout and stderr here, but
@@ -47,12 +66,53 @@ def run(*args: str) -> str:
     return result.stdout
 
 
+async def run_async(*args: str) -> str:
+    """
+    Like `run`, but without blocking the event loop, so that independent
+    programs can run concurrently with `asyncio.gather`.
+    """
+    # See `run` for why we only collect stderr with --verbose.
+    verbose = '--verbose' in sys.argv
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE if verbose else asyncio.subprocess.DEVNULL,
+    )
+    stdout_bytes, stderr_bytes = await proc.communicate()
+    stdout = stdout_bytes.decode('utf-8')
+    stderr = stderr_bytes.decode('utf-8') if stderr_bytes is not None else None
+
+    if proc.returncode != 0:
+        # See `run` for why we only print this with --verbose.
+        if verbose:
+            print('Command failed:', ' '.join(args))
+            print('Stdout:', stdout)
+            print('Stderr:', stderr)
+        assert proc.returncode is not None
+        raise subprocess.CalledProcessError(proc.returncode, args, stdout, stderr)
+
+    return stdout
+
+
+# The RPC URL of the network to test against, from $NETWORK, or the local test
+# validator if it is not set.
+_network = os.getenv('NETWORK') or 'http://127.0.0.1:8899'
+
+
 def get_network() -> str:
-    network = os.getenv('NETWORK')
-    if network is None:
-        return 'http://127.0.0.1:8899'
-    else:
-        return network
+    return _network
+
+
+def set_network(network: str) -> None:
+    """
+    Switch to a different network. RPC connections to the previous network are
+    replaced on their next use.
+    """
+    global _network
+    _network = network
+    # `solana_program_show` caches by program id only, so what it holds now is
+    # about the previous network.
+    solana_program_show.cache_clear()
 
 
 def solana(*args: str) -> str:
@@ -62,6 +122,15 @@ def solana(*args: str) -> str:
     return run('solana', '--url', get_network(), '--commitment', 'confirmed', *args)
 
 
+async def solana_async(*args: str) -> str:
+    """
+    Run 'solana' against network, without blocking the event loop.
+    """
+    return await run_async(
+        'solana', '--url', get_network(), '--commitment', 'confirmed', *args
+    )
+
+
 def spl_token(*args: str) -> str:
     """
     Run 'spl_token' against network.
@@ -69,6 +138,13 @@ def spl_token(*args: str) -> str:
     return run('spl-token', '--url', get_network(), *args)
 
 
+async def spl_token_async(*args: str) -> str:
+    """
+    Run 'spl_token' against network, without blocking the event loop.
+    """
+    return await run_async('spl-token', '--url', get_network(), *args)
+
+
 class SplTokenBalance(NamedTuple):
     # The raw amount is the amount in the smallest denomination of the token
     # (i.e. the number of Lamports for wrapped SOL), the UI amount is a float
@@ -81,29 +157,104 @@ def spl_token_balance(address: str) -> SplTokenBalance:
     """
     Return the balance of an SPL token account.
     """
-    result = run(
-        'spl-token',
-        '--url',
-        get_network(),
-        'balance',
-        '--address',
-        address,
-        '--output',
-        'json',
-    )
-    data: Dict[str, Any] = json.loads(result)
-    amount_raw = int(data['amount'])
-    amount_ui: float = data['uiAmount']
-    return SplTokenBalance(amount_raw, amount_ui)
+    return spl_token_balances([address])[0]
+
+
+def spl_token_balances(addresses: List[str]) -> List[SplTokenBalance]:
+    """
+    Return the balances of SPL token accounts, fetched in a single RPC call.
+    """
+    balances = []
+    for address, account_info in zip(addresses, rpc_get_multiple_accounts(addresses)):
+        if account_info is None:
+            raise ValueError(f'Token account {address} does not exist.')
+        token_amount = account_info['data']['parsed']['info']['tokenAmount']
+        amount_raw = int(token_amount['amount'])
+        amount_ui = amount_raw / 10 ** token_amount['decimals']
+        balances.append(SplTokenBalance(amount_raw, amount_ui))
+    return balances
 
 
 def solana_program_deploy(fname: str) -> str:
     """
     Deploy a .so file, return its program id.
+
+    Most of the cost of a deploy are the many transactions that write the
+    program into a buffer account. `solana program deploy` already sends all of
+    those at once through the TPU client, and confirms them with batched
+    signature status polls, so there is no point in doing it ourselves.
     """
     assert os.path.isfile(fname)
     result = solana('program', 'deploy', '--output', 'json', fname)
     program_id: str = json.loads(result)['programId']
+    solana_program_show.cache_clear()
+    return program_id
+
+
+def rpc_get_program(program_id: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """
+    Return the address and the decoded account info of the program data account
+    of an upgradeable program, or None if there is no such program.
+    """
+    # The program data address is derived from the program id, so we can fetch
+    # both accounts in one call.
+    program_data_address, _bump = find_program_address(
+        [b58decode(program_id)], BPF_LOADER_UPGRADEABLE_PROGRAM_ID
+    )
+    program, program_data = rpc_get_multiple_accounts(
+        [program_id, program_data_address]
+    )
+    if program is None or not isinstance(program['data'], dict):
+        return None
+    if program['data']['parsed']['type'] != 'program':
+        return None
+    if program_data is None or not isinstance(program_data['data'], dict):
+        return None
+    return program_data_address, program_data
+
+
+def _program_data_bytes(program_data: Dict[str, Any]) -> bytes:
+    # The loader stores the program behind a header, and pads it with zeros up
+    # to the maximum program size; the parsed info contains the part after the
+    # header.
+    data_b64, _encoding = program_data['data']['parsed']['info']['data']
+    return base64.b64decode(data_b64)
+
+
+def is_program_deployed(program_id: str, fname: str) -> bool:
+    """
+    Return whether `program_id` is an upgradeable program, and the program that
+    is deployed there is exactly the .so file.
+    """
+    program = rpc_get_program(program_id)
+    if program is None:
+        return False
+    _program_data_address, program_data = program
+    deployed = _program_data_bytes(program_data)
+    with open(fname, 'rb') as f:
+        local = f.read()
+    # Past the program, there must only be the zero padding, otherwise this is a
+    # longer program that happens to start with the same bytes.
+    padding = deployed[len(local) :]
+    return deployed[: len(local)] == local and padding.count(0) == len(padding)
+
+
+def solana_program_deploy_cached(fname: str, program_id_fname: str) -> str:
+    """
+    Like `solana_program_deploy`, but if the program that we deployed before
+    (the id is stored in `program_id_fname`) is still on chain and identical to
+    the .so file, reuse it rather than uploading it again.
+    """
+    if os.path.isfile(program_id_fname):
+        with open(program_id_fname, 'r') as f:
+            program_id = f.read().strip()
+        if is_program_deployed(program_id, fname):
+            return program_id
+
+    program_id = solana_program_deploy(fname)
+    os.makedirs(os.path.dirname(program_id_fname), exist_ok=True)
+    with open(program_id_fname, 'w') as f:
+        f.write(program_id)
     return program_id
 
 
@@ -116,79 +267,351 @@ class SolanaProgramInfo(NamedTuple):
     data_len: int
 
 
+@functools.lru_cache(maxsize=128)
 def solana_program_show(program_id: str) -> SolanaProgramInfo:
     """
-    Return information about a program.,
+    Return information about a program, like `solana program show`, but read
+    directly over RPC.
+
+    The result is cached, because a program does not change unless we deploy
+    it again, and `solana_program_deploy` clears the cache when we do. Like the
+    CLI, this reads at confirmed commitment, so it sees a program straight
+    after `solana_program_deploy`.
     """
-    result = solana('program', 'show', '--output', 'json', program_id)
-    data: Dict[str, Any] = json.loads(result)
+    program = rpc_get_program(program_id)
+    if program is None:
+        raise ValueError(f'{program_id} is not an upgradeable program.')
+    program_data_address, program_data = program
+    info = program_data['data']['parsed']['info']
     return SolanaProgramInfo(
-        program_id=data['programId'],
-        owner=data['owner'],
-        program_data_address=data['programdataAddress'],
-        upgrade_authority=data['authority'],
-        last_deploy_slot=data['lastDeploySlot'],
-        data_len=data['dataLen'],
+        program_id=program_id,
+        owner=BPF_LOADER_UPGRADEABLE_PROGRAM_ID,
+        program_data_address=program_data_address,
+        upgrade_authority=info['authority'] or 'none',
+        last_deploy_slot=info['slot'],
+        data_len=len(_program_data_bytes(program_data)),
     )
 
 
 def create_test_account(keypair_fname: str, *, fund: bool = True) -> TestAccount:
     """
-    Generate a key pair, fund the account with 1 SOL, and return its public key.
+    Generate a key pair, fund the account with 1 SOL from the fee payer, and
+    return its public key.
     """
-    run(
-        'solana-keygen',
-        'new',
-        '--no-bip39-passphrase',
-        '--force',
-        '--silent',
-        '--outfile',
-        keypair_fname,
-    )
-    pubkey = run('solana-keygen', 'pubkey', keypair_fname).strip()
+    # Generating the key ourselves is a lot faster than starting
+    # `solana-keygen new` for every account.
+    pubkey = write_new_keypair(keypair_fname)
     if fund:
+        # Transfer rather than airdrop, this works on any network, also on one
+        # without a faucet.
         solana('transfer', '--allow-unfunded-recipient', pubkey, '1.0')
     return TestAccount(pubkey, keypair_fname)
 
 
-def create_spl_token_account(owner_keypair_fname: str, minter: str) -> str:
+TOKEN_PROGRAM_ID = 'TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA'
+ASSOCIATED_TOKEN_PROGRAM_ID = 'ATokenGPvbdGVxr1b2hvZbsiqW5xWH25efTNsLJA8knL'
+BPF_LOADER_UPGRADEABLE_PROGRAM_ID = 'BPFLoaderUpgradeab1e11111111111111111111111'
+
+_B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+
+def b58encode(data: bytes) -> str:
+    n = int.from_bytes(data, 'big')
+    result = ''
+    while n > 0:
+        n, digit = divmod(n, 58)
+        result = _B58_ALPHABET[digit] + result
+    # Leading zero bytes are encoded as leading '1's.
+    num_zeros = len(data) - len(data.lstrip(b'\0'))
+    return '1' * num_zeros + result
+
+
+def b58decode(data: str, length: int = 32) -> bytes:
+    n = 0
+    for char in data:
+        n = n * 58 + _B58_ALPHABET.index(char)
+    return n.to_bytes(length, 'big')
+
+
+# Parameters of the ed25519 curve, see RFC 8032.
+_ED25519_P = 2**255 - 19
+_ED25519_D = -121665 * pow(121666, -1, _ED25519_P) % _ED25519_P
+
+
+def _is_on_ed25519_curve(point: bytes) -> bool:
+    """
+    Return whether the 32 bytes are a compressed point on the ed25519 curve,
+    i.e. whether a private key could exist for them.
+    """
+    p = _ED25519_P
+    y = int.from_bytes(point, 'little') & ((1 << 255) - 1)
+    # The x-coordinate satisfies x^2 = (y^2 - 1) / (d y^2 + 1), so the point is
+    # on the curve if and only if that ratio is a square modulo p.
+    y2 = y * y % p
+    x2 = (y2 - 1) * pow(_ED25519_D * y2 + 1, -1, p) % p
+    return x2 == 0 or pow(x2, (p - 1) // 2, p) == 1
+
+
+# A point in extended coordinates (X, Y, Z, T), with x = X/Z, y = Y/Z, and
+# x y = T/Z.
+_Ed25519Point = Tuple[int, int, int, int]
+
+
+def _ed25519_add(p1: _Ed25519Point, p2: _Ed25519Point) -> _Ed25519Point:
+    p = _ED25519_P
+    x1, y1, z1, t1 = p1
+    x2, y2, z2, t2 = p2
+    a = (y1 - x1) * (y2 - x2) % p
+    b = (y1 + x1) * (y2 + x2) % p
+    c = 2 * t1 * t2 * _ED25519_D % p
+    d = 2 * z1 * z2 % p
+    e, f, g, h = b - a, d - c, d + c, b + a
+    return e * f % p, g * h % p, f * g % p, e * h % p
+
+
+def _ed25519_base_point() -> _Ed25519Point:
+    p = _ED25519_P
+    y = 4 * pow(5, -1, p) % p
+    x2 = (y * y - 1) * pow(_ED25519_D * y * y + 1, -1, p) % p
+    x = pow(x2, (p + 3) // 8, p)
+    if (x * x - x2) % p != 0:
+        x = x * pow(2, (p - 1) // 4, p) % p
+    if x % 2 != 0:
+        x = p - x
+    return x, y, 1, x * y % p
+
+
+def _ed25519_public_key(seed: bytes) -> bytes:
+    """
+    Derive the public key from the 32-byte secret seed, see RFC 8032 5.1.5.
+    """
+    p = _ED25519_P
+    digest = hashlib.sha512(seed).digest()
+    scalar = int.from_bytes(digest[:32], 'little')
+    scalar &= (1 << 254) - 8
+    scalar |= 1 << 254
+
+    result: _Ed25519Point = (0, 1, 1, 0)
+    addend = _ed25519_base_point()
+    while scalar > 0:
+        if scalar & 1:
+            result = _ed25519_add(result, addend)
+        addend = _ed25519_add(addend, addend)
+        scalar >>= 1
+
+    x, y, z, _t = result
+    z_inv = pow(z, -1, p)
+    x, y = x * z_inv % p, y * z_inv % p
+    return (y | ((x & 1) << 255)).to_bytes(32, 'little')
+
+
+def write_new_keypair(keypair_fname: str) -> str:
+    """
+    Generate a key pair and write it in the format of `solana-keygen`, without
+    running it. Return the public key.
+    """
+    seed = secrets.token_bytes(32)
+    public_key = _ed25519_public_key(seed)
+    # Like `solana-keygen`, make the key only readable by its owner. The mode of
+    # `os.open` only applies to new files, so also set it on an existing one.
+    fd = os.open(keypair_fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with open(fd, 'w') as f:
+        json.dump(list(seed + public_key), f)
+    return b58encode(public_key)
+
+
+def find_program_address(seeds: List[bytes], program_id: str) -> Tuple[str, int]:
+    """
+    Derive a program address and its bump seed, like `Pubkey::find_program_address`.
+    """
+    program_id_bytes = b58decode(program_id)
+    for bump in range(255, -1, -1):
+        address = hashlib.sha256(
+            b''.join(seeds)
+            + bytes([bump])
+            + program_id_bytes
+            + b'ProgramDerivedAddress'
+        ).digest()
+        if not _is_on_ed25519_curve(address):
+            return b58encode(address), bump
+    raise ValueError('Unable to find a viable program address bump seed')
+
+
+def get_associated_token_address(owner: str, mint: str) -> str:
     """
-    Creates an spl token for the given minter
-    spl_token command returns 'Creating account <address>
-             Signature: <tx-signature>'
-    This function returns <address>
+    Return the address of the associated token account of `owner` for `mint`.
+    This is derived locally, it does not need to exist.
     """
-    return (
-        spl_token('create-account', minter, '--owner', owner_keypair_fname)
-        .split('\n')[0]
-        .split(' ')[2]
+    address, _bump = find_program_address(
+        [b58decode(owner), b58decode(TOKEN_PROGRAM_ID), b58decode(mint)],
+        ASSOCIATED_TOKEN_PROGRAM_ID,
     )
+    return address
 
 
-def create_test_accounts(*, num_accounts: int) -> List[TestAccount]:
-    result = []
+def keypair_pubkey(keypair_fname: str) -> str:
+    """
+    Return the public key of a keypair file, without running `solana-keygen`.
+    The file holds the 64-byte secret key, the last 32 bytes are the public key.
+    """
+    with open(keypair_fname, 'r') as f:
+        secret_key: List[int] = json.load(f)
+    return b58encode(bytes(secret_key[32:]))
+
+
+def get_default_keypair_path() -> str:
+    """
+    Return the path of the keypair that the Solana CLI uses by default, which
+    pays for the transactions that we send with it.
+    """
+    config_path = os.path.expanduser('~/.config/solana/cli/config.yml')
+    if os.path.isfile(config_path):
+        with open(config_path, 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key.strip() == 'keypair_path':
+                    return value.strip().strip('\'"')
+    return os.path.expanduser('~/.config/solana/id.json')
+
+
+_CREATING_ACCOUNT_RE = re.compile(r'^Creating account (\S+)', re.MULTILINE)
+
+
+def create_spl_token_account(owner_keypair_fname: str, minter: str) -> str:
+    """
+    Creates the associated spl token account of the owner for the given minter,
+    if it does not exist yet, and returns its address.
+    """
+    address = get_associated_token_address(keypair_pubkey(owner_keypair_fname), minter)
+    # This reads at confirmed commitment, so an account that we created moments
+    # ago is found, and we don't try to create it a second time.
+    if rpc_get_account_info(address) is not None:
+        return address
 
-    for i in range(num_accounts):
-        fname = f'test-key-{i + 1}.json'
-        test_account = create_test_account(fname)
-        result.append(test_account)
+    # spl_token command returns 'Creating account <address>
+    #          Signature: <tx-signature>'
+    output = spl_token('create-account', minter, '--owner', owner_keypair_fname)
+    match = _CREATING_ACCOUNT_RE.search(output)
+    assert match is not None, f'Unexpected spl-token output: {output}'
+    assert match.group(1) == address
+    return address
 
+
+async def _fund_from_fee_payer(addresses: List[str], sol_per_account: float) -> None:
+    await asyncio.gather(
+        *(
+            solana_async(
+                'transfer', '--allow-unfunded-recipient', address, str(sol_per_account)
+            )
+            for address in addresses
+        )
+    )
+
+
+def create_test_accounts_bulk(
+    keypair_fnames: List[str], *, sol_per_account: float = 1.0, airdrop: bool = False
+) -> List[TestAccount]:
+    """
+    Generate key pairs, and fund all of the accounts at once. This is a lot
+    faster than calling `create_test_account` with `fund=True` for every account,
+    because we wait for all transfers at the same time rather than one by one.
+
+    By default, the accounts are funded from the fee payer, which works on any
+    network. With `airdrop=True`, they are airdropped in a single batch instead,
+    which is faster still, but needs a network with a faucet, like the test
+    validator.
+    """
+    result = [create_test_account(fname, fund=False) for fname in keypair_fnames]
+    addresses = [test_account.pubkey for test_account in result]
+    if airdrop:
+        rpc_request_airdrops(addresses, lamports=int(sol_per_account * 1_000_000_000))
+    else:
+        asyncio.run(_fund_from_fee_payer(addresses, sol_per_account))
     return result
 
 
-def wait_for_slots(slots: int) -> None:
-    import time
+def create_test_accounts(*, num_accounts: int) -> List[TestAccount]:
+    return create_test_accounts_bulk(
+        [f'test-key-{i + 1}.json' for i in range(num_accounts)]
+    )
+
 
+def wait_for_slots(slots: int) -> None:
     """
     Blocks waiting until `slots` slots have passed.
     """
-    slots_beginning = int(solana('get-slot'))
-    while True:
-        # Wait 1 second to poll next slot height (around 2 slots)
-        time.sleep(1)
-        elapsed_slots = int(solana('get-slot')) - slots_beginning
-        if elapsed_slots >= slots:
-            break
+    slots_beginning = rpc_get_slot()
+    # A slot takes around 400ms. Start polling quickly, so short waits end
+    # soon after the slot arrives, and back off for longer waits.
+    sleep_seconds = 0.05
+    while rpc_get_slot() - slots_beginning < slots:
+        time.sleep(sleep_seconds)
+        sleep_seconds = min(sleep_seconds * 1.5, 0.5)
+
+
+# Keep-alive connections to the RPC endpoint, reused across calls, so we don't
+# pay for connection setup on every call. An `HTTPConnection` can only have one
+# request in flight, so every thread gets its own connection. That way, calls
+# from different threads run concurrently instead of queueing for one
+# connection.
+_rpc_connections = threading.local()
+
+# How long to wait for the validator to answer an RPC call, so a hung validator
+# fails the test instead of blocking it forever.
+RPC_TIMEOUT_SECONDS = 30
+
+
+def _get_rpc_connection(network: str) -> HTTPConnection:
+    """
+    Return the calling thread's connection to `network`, connect if needed.
+    """
+    connection: Optional[HTTPConnection] = getattr(_rpc_connections, 'connection', None)
+    if connection is not None and _rpc_connections.network == network:
+        return connection
+
+    if connection is not None:
+        connection.close()
+    url = urlsplit(network)
+    connection_class = HTTPSConnection if url.scheme == 'https' else HTTPConnection
+    connection = connection_class(url.netloc, timeout=RPC_TIMEOUT_SECONDS)
+    _rpc_connections.connection = connection
+    _rpc_connections.network = network
+    return connection
+
+
+def _rpc_post(body: Any) -> Any:
+    """
+    Post a JSON-RPC request (or a batch of requests) to the network, return the
+    decoded response.
+    """
+    network = get_network()
+    url = urlsplit(network)
+    # Keep the query, some RPC providers take the API key there.
+    path = url.path or '/'
+    if url.query:
+        path += '?' + url.query
+    data = json.dumps(body).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+
+    for attempt in range(2):
+        connection = _get_rpc_connection(network)
+        try:
+            connection.request('POST', path, body=data, headers=headers)
+            return json.load(connection.getresponse())
+        except (HTTPException, ConnectionError):
+            # The server may have closed the connection in the meantime, for
+            # example because the validator restarted. Reconnect once.
+            connection.close()
+            _rpc_connections.connection = None
+            if attempt > 0:
+                raise
+
+
+# Ids for `solana_rpc` requests. Ids only need to be unique among the requests in
+# flight on one connection, and `next` on a counter is atomic, so one counter
+# serves all threads.
+_rpc_ids = itertools.count(1)
 
 
 def solana_rpc(method: str, params: List[Any]) -> Any:
@@ -201,34 +624,209 @@ def solana_rpc(method: str, params: List[Any]) -> Any:
     """
     body = {
         'jsonrpc': '2.0',
-        'id': str(uuid4()),
+        'id': next(_rpc_ids),
         'method': method,
         'params': params,
     }
-    req = request.Request(
-        get_network(),
-        method='POST',
-        data=json.dumps(body).encode('utf-8'),
-        headers={
-            'Content-Type': 'application/json',
-        },
+    return _rpc_post(body)
+
+
+def solana_rpc_batch(calls: List[Tuple[str, List[Any]]]) -> List[Any]:
+    """
+    Make multiple Solana RPC calls in a single request, return the responses in
+    the same order as `calls`.
+
+    Like `solana_rpc`, this is sloppy and only suitable for tests.
+    """
+    body = [
+        {
+            'jsonrpc': '2.0',
+            'id': i,
+            'method': method,
+            'params': params,
+        }
+        for i, (method, params) in enumerate(calls)
+    ]
+    responses: List[Any] = _rpc_post(body)
+    # The server is allowed to respond to a batch in any order.
+    responses.sort(key=lambda response: response['id'])
+    return responses
+
+
+def rpc_get_multiple_accounts(addresses: List[str]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Call getMultipleAccounts, see https://docs.solana.com/developing/clients/jsonrpc-api#getmultipleaccounts.
+    """
+    # Read at the same commitment as the CLI does, the server default of
+    # finalized lags the confirmed state by about 32 slots.
+    result: Dict[str, Any] = solana_rpc(
+        method='getMultipleAccounts',
+        params=[addresses, {'encoding': 'jsonParsed', 'commitment': 'confirmed'}],
     )
-    response = request.urlopen(req)
-    return json.load(response)
+    # Every value is either an object with decoded account info, or None, if
+    # the account does not exist.
+    account_infos: List[Optional[Dict[str, Any]]] = result['result']['value']
+    return account_infos
 
 
 def rpc_get_account_info(address: str) -> Optional[Dict[str, Any]]:
     """
-    Call getAccountInfo, see https://docs.solana.com/developing/clients/jsonrpc-api#getaccountinfo.
+    Get the decoded account info of a single account, or None if the account
+    does not exist. See also `rpc_get_multiple_accounts`, which fetches many
+    accounts in one call.
+    """
+    return rpc_get_multiple_accounts([address])[0]
+
+
+def rpc_get_balances(addresses: List[str]) -> Dict[str, int]:
+    """
+    Return the balances of accounts, fetched in a single RPC call. For SPL token
+    accounts, this is the raw token amount, for other accounts it is the
+    balance in Lamports. Accounts that do not exist have a balance of 0.
+    """
+    balances: Dict[str, int] = {}
+    for address, account_info in zip(addresses, rpc_get_multiple_accounts(addresses)):
+        if account_info is None:
+            balances[address] = 0
+            continue
+        data = account_info['data']
+        # Token accounts are parsed, the data of other accounts is either not
+        # parsed at all, or parsed without a token amount.
+        info = data['parsed'].get('info', {}) if isinstance(data, dict) else {}
+        if 'tokenAmount' in info:
+            balances[address] = int(info['tokenAmount']['amount'])
+        else:
+            balances[address] = account_info['lamports']
+    return balances
+
+
+def rpc_get_balance(address: str) -> int:
+    """
+    Return the balance of an account, see also `rpc_get_balances`.
+    """
+    return rpc_get_balances([address])[address]
+
+
+def rpc_get_slot() -> int:
+    """
+    Return the current confirmed slot.
     """
     result: Dict[str, Any] = solana_rpc(
-        method='getAccountInfo',
-        params=[address, {'encoding': 'jsonParsed'}],
+        method='getSlot', params=[{'commitment': 'confirmed'}]
     )
-    # The value is either an object with decoded account info, or None, if the
-    # account does not exist.
-    account_info: Optional[Dict[str, Any]] = result['result']['value']
-    return account_info
+    slot: int = result['result']
+    return slot
+
+
+def rpc_get_block_height() -> int:
+    """
+    Return the current confirmed block height.
+    """
+    result: Dict[str, Any] = solana_rpc(
+        method='getBlockHeight', params=[{'commitment': 'confirmed'}]
+    )
+    block_height: int = result['result']
+    return block_height
+
+
+def rpc_confirm_transactions(signatures: List[str], timeout_seconds: int = 60) -> None:
+    """
+    Block until all transactions are confirmed, raise if any of them failed.
+
+    The statuses of all pending transactions are polled with a single call to
+    getSignatureStatuses, rather than confirming them one by one.
+    """
+    pending = list(signatures)
+    deadline = time.monotonic() + timeout_seconds
+    sleep_seconds = 0.05
+
+    while len(pending) > 0:
+        result: Dict[str, Any] = solana_rpc(
+            method='getSignatureStatuses',
+            params=[pending],
+        )
+        still_pending = []
+        for signature, status in zip(pending, result['result']['value']):
+            # The status is None if the validator has not seen the transaction yet.
+            if status is None or status['confirmationStatus'] == 'processed':
+                still_pending.append(signature)
+            elif status['err'] is not None:
+                raise RuntimeError(f'Transaction {signature} failed: {status["err"]}')
+        pending = still_pending
+
+        if len(pending) > 0:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'Transactions not confirmed: {pending}')
+            time.sleep(sleep_seconds)
+            sleep_seconds = min(sleep_seconds * 2, 0.5)
+
+
+def rpc_request_airdrops(addresses: List[str], lamports: int) -> None:
+    """
+    Airdrop `lamports` to every address, all requested in a single batch, and
+    wait until the airdrops are confirmed. This needs a network with a faucet,
+    like the test validator.
+    """
+    # The server does not answer an empty batch with a list of responses.
+    if len(addresses) == 0:
+        return
+
+    responses = solana_rpc_batch(
+        [('requestAirdrop', [address, lamports]) for address in addresses]
+    )
+    for response in responses:
+        assert 'result' in response, f'Airdrop failed: {response}'
+    rpc_confirm_transactions([response['result'] for response in responses])
+
+
+TOKEN_SWAP_CLI_MANIFEST = os.path.join(
+    ROOT_PATH, 'mev-tests/helper-programs/token-swap-cli/Cargo.toml'
+)
+
+_token_swap_cli_lock = threading.Lock()
+# The path of the built executable, or None if it has not been built yet.
+_token_swap_cli_path: Optional[str] = None
+
+
+def build_token_swap_cli() -> str:
+    """
+    Build the token swap CLI, return the path of the executable.
+
+    We take the path from cargo's build messages, rather than assuming it is in
+    the `target` directory next to the manifest, so `CARGO_TARGET_DIR` and
+    `build.target-dir` are respected, like they were with `cargo run`.
+    """
+    output = run(
+        'cargo',
+        'build',
+        '--manifest-path',
+        TOKEN_SWAP_CLI_MANIFEST,
+        '--message-format=json',
+    )
+    for line in output.splitlines():
+        message = json.loads(line)
+        if (
+            message.get('reason') == 'compiler-artifact'
+            and message['target']['name'] == 'token-swap-cli'
+            and message.get('executable') is not None
+        ):
+            executable: str = message['executable']
+            return executable
+    raise RuntimeError('cargo build did not produce the token swap CLI.')
+
+
+def run_token_swap_cli(*args: str) -> str:
+    """
+    Run the token swap CLI, return its stdout.
+
+    The CLI is built once per session, and then executed directly. `cargo run`
+    would check whether it is up to date again on every call.
+    """
+    global _token_swap_cli_path
+    with _token_swap_cli_lock:
+        if _token_swap_cli_path is None:
+            _token_swap_cli_path = build_token_swap_cli()
+    return run(_token_swap_cli_path, *args)
 
 
 class TokenPool(NamedTuple):
@@ -248,13 +846,17 @@ class TokenPool(NamedTuple):
         amount: int,
         minimum_amount_out: int,
     ) -> str:
+        """
+        Swap through this pool, return the signature of the transaction.
+
+        The token swap CLI only returns once the transaction is confirmed, so
+        the validator has logged the swap by the time this returns. The tests
+        rely on that to find the swap at the end of the MEV log, which is also
+        why swaps are not submitted together and confirmed in one batch: the
+        log entries of different swaps would interleave.
+        """
         swap_json = json.loads(
-            run(
-                'cargo',
-                'run',
-                '--manifest-path',
-                './mev-tests/helper-programs/token-swap-cli/Cargo.toml',
-                '--',
+            run_token_swap_cli(
                 '--token-swap-program-id',
                 self.token_swap_program_id,
                 '--token-swap-a-account',
@@ -288,13 +890,13 @@ class TokenPool(NamedTuple):
         amount: int,
         minimum_amount_out: int,
     ) -> str:
+        """
+        Swap through this pool by calling the token swap program from
+        `inner_program`, return the signature of the transaction. Like `swap`,
+        this returns once the transaction is confirmed.
+        """
         swap_json = json.loads(
-            run(
-                'cargo',
-                'run',
-                '--manifest-path',
-                './mev-tests/helper-programs/token-swap-cli/Cargo.toml',
-                '--',
+            run_token_swap_cli(
                 '--token-swap-program-id',
                 self.token_swap_program_id,
                 '--token-swap-a-account',
@@ -331,12 +933,7 @@ def deploy_token_pool(
     token_mint_b_account: str,
 ) -> TokenPool:
     init_json = json.loads(
-        run(
-            'cargo',
-            'run',
-            '--manifest-path',
-            './mev-tests/helper-programs/token-swap-cli/Cargo.toml',
-            '--',
+        run_token_swap_cli(
             '--token-swap-program-id',
             token_swap_program_id,
             '--token-swap-a-account',
@@ -358,21 +955,52 @@ def deploy_token_pool(
     )
 
 
+# The last lines that the validator printed, see `start_validator`. This is
+# shared between restarts, so it also holds the output that led up to one.
+_validator_output: Deque[str] = collections.deque(maxlen=16384)
+
+
+def _collect_validator_output(test_validator: subprocess.Popen[bytes]) -> None:
+    assert test_validator.stdout is not None
+    for line in test_validator.stdout:
+        _validator_output.append(line.decode('utf-8', errors='replace'))
+
+
+def get_validator_output() -> str:
+    """
+    Return the last lines that the validator printed to stdout and stderr.
+    """
+    return ''.join(_validator_output)
+
+
 def start_validator(config_path: Optional[str] = None) -> subprocess.Popen[bytes]:
     """
-    Start the validator with an optional .toml config file, pipe its stdout to /dev/null.
+    Start the validator with an optional .toml config file. Its output is kept
+    in memory, see `get_validator_output`.
     """
-    cmds = ['solana-test-validator']
+    # By default, the validator writes its log to a file in the ledger, and only
+    # a banner to stdout. With `--log`, the log goes to stderr, which we collect.
+    cmds = ['solana-test-validator', '--log']
     if config_path is not None:
         cmds += ['--mev-config-path', config_path]
+    # Run the validator directly, not through a shell. With `shell=True`, the
+    # shell would only run the first element of `cmds` and drop the arguments,
+    # and `terminate()` would stop the shell but leave the validator running.
+    # If a shell is ever needed, run `['/bin/sh', '-c', shlex.join(cmds)]`.
+    # The validator puts its ledger in the working directory, so this keeps it
+    # in `test-ledger` at the repository root between runs.
     test_validator = subprocess.Popen(
-        cmds,
-        stdout=subprocess.DEVNULL,
-        # Somehow, CI only works if `shell=True`, so this argument is left here on
-        # purpose. This doesn't capture arguments (or paths, need to investigate),
-        # For now, we'll keep it commented.
-        # shell=True,
+        cmds, cwd=ROOT_PATH, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
     )
+    # Keep draining the pipe, otherwise the validator blocks once it is full.
+    # We only keep the tail, so we can show it when a test fails, without
+    # having to re-run the tests to see what the validator was doing.
+    threading.Thread(
+        target=_collect_validator_output, args=(test_validator,), daemon=True
+    ).start()
+    # Make sure we don't leak the validator if the caller fails before it
+    # terminates the validator. Terminating an exited process is a no-op.
+    atexit.register(test_validator.terminate)
     wait_validator()
     return test_validator
 
@@ -382,37 +1010,53 @@ def restart_validator(
 ) -> subprocess.Popen[bytes]:
     """
     Stops a running validator and re-start keeping the ledger
+
+    The validator only reads its MEV config on startup, so a restart is the only
+    way to make it pick up a new config. It can't be reloaded in place, because
+    the MEV log thread refers to the configured paths by index.
     """
     test_validator.terminate()
-    sleep_seconds = 2
-    if not test_validator.poll():
-        time.sleep(sleep_seconds)
+    # Wait for the old validator to actually exit, so it releases the ledger and
+    # its ports before the new one starts.
+    try:
+        test_validator.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        test_validator.kill()
+        test_validator.wait()
 
     ## restart validator with toml file
-    new_validator = start_validator(config_path=config_file)
-    wait_validator()
-    return new_validator
+    # `start_validator` already waits for the validator to produce blocks.
+    return start_validator(config_path=config_file)
 
 
-def wait_validator() -> None:
-    last_observed_block_height: Optional[int] = None
-    for _ in range(60):
-        result = subprocess.run(
-            ['solana', '--url', 'http://127.0.0.1:8899', 'block-height'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL,
-        )
-        if result.returncode == 0:
-            current_block_height = int(result.stdout)
-            if (
-                last_observed_block_height is not None
-                and current_block_height > last_observed_block_height
-            ):
-                break
-            last_observed_block_height = current_block_height
-
-        sleep_seconds = 1
+def wait_validator(timeout_seconds: int = 60) -> None:
+    """
+    Block until the validator is healthy and produces blocks.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    sleep_seconds = 0.1
+    while True:
+        try:
+            result: Dict[str, Any] = solana_rpc(method='getHealth', params=[])
+        except ConnectionError:
+            # The validator is not listening yet.
+            result = {}
+        if result.get('result') == 'ok':
+            break
+        if time.monotonic() > deadline:
+            raise TimeoutError('Validator did not become healthy.')
+        time.sleep(sleep_seconds)
+        sleep_seconds = min(sleep_seconds * 2, 1.0)
+
+    # A healthy validator has caught up, but we also want it to be producing
+    # blocks before we send it transactions.
+    block_height_start = rpc_get_block_height()
+    sleep_seconds = 0.05
+    while rpc_get_block_height() <= block_height_start:
+        if time.monotonic() > deadline:
+            raise TimeoutError('Validator does not produce blocks.')
         time.sleep(sleep_seconds)
+        sleep_seconds = min(sleep_seconds * 1.5, 0.5)
 
 
 def compile_bpf_program(cargo_manifest: str) -> None:
@@ -424,9 +1068,81 @@ def compile_bpf_program(cargo_manifest: str) -> None:
     )
 
 
+def hash_crate_sources(cargo_manifest: str) -> str:
+    """
+    Return a hash of everything that goes into building the crate: its
+    manifest, its sources, and the manifest and lock file of the workspace. The
+    workspace manifest holds the profile settings.
+    """
+    crate_dir = os.path.dirname(cargo_manifest)
+    workspace_dir = os.path.dirname(crate_dir)
+    fnames = [
+        cargo_manifest,
+        os.path.join(workspace_dir, 'Cargo.toml'),
+        os.path.join(workspace_dir, 'Cargo.lock'),
+    ]
+    for dirpath, _dirnames, filenames in os.walk(os.path.join(crate_dir, 'src')):
+        fnames.extend(os.path.join(dirpath, filename) for filename in filenames)
+
+    sources_hash = hashlib.sha256()
+    for fname in sorted(fnames):
+        if not os.path.isfile(fname):
+            continue
+        sources_hash.update(fname.encode('utf-8') + b'\0')
+        with open(fname, 'rb') as f:
+            sources_hash.update(hashlib.sha256(f.read()).digest())
+    return sources_hash.hexdigest()
+
+
+def compile_bpf_program_cached(cargo_manifest: str, so_fname: str) -> None:
+    """
+    Like `compile_bpf_program`, but skip the build if `so_fname` was built from
+    the same sources before. Even for an unchanged crate, `cargo build-bpf`
+    takes a while to check that there is nothing to do.
+    """
+    sources_hash = hash_crate_sources(cargo_manifest)
+    hash_fname = so_fname + '.sources-sha256'
+    if os.path.isfile(so_fname) and os.path.isfile(hash_fname):
+        with open(hash_fname, 'r') as f:
+            if f.read().strip() == sources_hash:
+                return
+
+    compile_bpf_program(cargo_manifest)
+    with open(hash_fname, 'w') as f:
+        f.write(sources_hash)
+
+
 def read_mev_log(log_path: str):
     logs = []
     with open(log_path, 'r') as f:
         for line in f:
             logs.append(json.loads(line))
     return logs
+
+
+class MevLogTail:
+    """
+    Follows the MEV log, and returns the entries that were appended to it since
+    the last read, so no entry is parsed twice.
+    """
+
+    def __init__(self, log_path: str, *, from_start: bool = False) -> None:
+        self.log_path = log_path
+        # By default, start at the current end of the log, so the first read
+        # returns only the entries that were added after creating the tail.
+        self.offset = 0
+        if not from_start and os.path.isfile(log_path):
+            self.offset = os.path.getsize(log_path)
+
+    def read_new(self) -> List[Any]:
+        """
+        Return the entries added since the last read, oldest first.
+        """
+        with open(self.log_path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # The validator may still be writing the last line, only consume
+        # complete lines, and pick up the rest on the next read.
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        return [json.loads(line) for line in data[:end].splitlines()]